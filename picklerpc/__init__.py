@@ -1,4 +1,5 @@
 from picklerpc.client import PickleRpcClient
+from picklerpc.codec import RemoteError
 from picklerpc.server import PickleRpcServer
 
-__all__ = ['PickleRpcClient', 'PickleRpcServer']
+__all__ = ['PickleRpcClient', 'PickleRpcServer', 'RemoteError']
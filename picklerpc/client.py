@@ -7,43 +7,370 @@ import logging
 import pickle
 import socket
 
-from contextlib import closing
+from functools import lru_cache, partial
+from itertools import chain
+from threading import Thread
+
+from picklerpc.codec import check_codec, dumps, loads
+from picklerpc.framing import open_reader, recv_frame, send_frame, send_frames
+
+# With cache_args on, requests whose arguments are all of these exact types
+# are encoded once and reused. They're immutable, so the encoding can't go
+# stale. Floats are left out: 0.0 and -0.0 are equal, so they'd share an entry.
+_CACHEABLE_TYPES = frozenset((str, bytes, int, bool, type(None)))
+# Strings and bytes longer than this, and ints wider than this many bytes,
+# aren't cached, since the cache keeps them alive alongside their encoding.
+_CACHEABLE_SIZE = 1024
+_ARG_CACHE_SIZE = 128
+
+
+def _cacheable(values):
+    """
+    Check whether a call's argument values can go through the cache_args
+    cache.
+
+    Args:
+        values (tuple): Positional and keyword argument values.
+
+    Returns (bool):
+        True if they're all small values of the cacheable types.
+    """
+    for value in values:
+        kind = type(value)
+        if kind not in _CACHEABLE_TYPES:
+            return False
+        if kind is int:
+            if value.bit_length() > _CACHEABLE_SIZE * 8:
+                return False
+        elif kind is not bool and value is not None and len(value) > _CACHEABLE_SIZE:
+            return False
+    return True
+
+
+def _encode_request(command, args, kwargs, arg_types, codec, protocol):
+    """
+    Encode a request for the cache_args cache.
+
+    Args:
+        command (str): Method to call.
+        args (tuple): Tuple of positional arguments.
+        kwargs (tuple): Keyword arguments, as (name, value) pairs.
+        arg_types (tuple): Types of all the argument values. Only part of the
+            cache key, so that 1 and True are cached apart.
+        codec (str): Codec name.
+        protocol (int): Pickle protocol.
+
+    Returns (bytes):
+        Encoded request.
+    """
+    return dumps((command, args, dict(kwargs)), codec=codec, protocol=protocol)
+
+
+def _frames_size(frames):
+    """
+    Add up the size of some request frames.
+
+    Args:
+        frames (list): (payload, buffers) tuples.
+
+    Returns (int):
+        Total size of the payloads and buffers, in bytes.
+    """
+    return sum(len(payload) + sum(data.nbytes for data in buffers)
+               for payload, buffers in frames)
 
 
 class PickleRpcClient:
     """A client for PickleRpcServer. Use the client to connect to a server."""
 
-    def __init__(self, server, port, protocol=None):
+    def __init__(self, server, port, protocol=None, codec='pickle', cache_args=False):
         """
         Prepare a PickleRpcClient instance for use.
 
         Args:
             server (str): Hostname or IP address to connect to.
             port (int): Port to connect to.
+            protocol (int): Pickle protocol to use. Defaults to None (highest
+                available).
+            codec (str): Serialization codec to ask the server for, 'pickle'
+                or 'msgpack'. If the server can't use it, cli_codec is set to
+                the one it picks instead. Defaults to 'pickle'.
+            cache_args (bool): Cache encoded requests for calls made again
+                with the same arguments, when those are all short strings or
+                bytes, ints, bools or None. Defaults to False.
         """
-        self._log.debug(locals())
+        self._log = logging.getLogger('picklerpc.{}'.format(self.__class__.__name__))
         self.cli_server = server
         self.cli_port = port
-        self.cli_protocol = protocol
-        # Create socket
+        self.cli_protocol = pickle.HIGHEST_PROTOCOL if protocol is None else int(protocol)
+        self.cli_codec = check_codec(codec)
+        self._encode_cached = (
+            lru_cache(maxsize=_ARG_CACHE_SIZE)(_encode_request) if cache_args else None)
+        # Connections are opened as needed and kept for later calls. Each call
+        # takes one for itself, so threads sharing a client each get their own.
+        self._idle = []
+        # Requests up to this size fit in the socket's send buffer, so they
+        # can be sent without waiting on the server. Set by _connect.
+        self._send_buffer_size = 0
+        # Connect now, to settle the codec before encoding any requests.
+        self._idle.append(self._connect())
         self._setup_obj()
 
-    @property
-    def _log(self):
-        """Logger."""
-        return logging.getLogger('picklerpc.PickleRpcClient')
+    def __enter__(self):
+        """Use the client as a context manager, closing it on the way out."""
+        return self
+
+    def __exit__(self, *exc_info):
+        """Close the client."""
+        self.close()
+
+    def _connect(self):
+        """
+        Open a new connection to the server, and agree on a codec with it.
+
+        Returns (tuple):
+            Connected socket, and a reader for it from open_reader.
+        """
+        self._log.debug('Connecting to %s:%i', self.cli_server, self.cli_port)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        try:
+            sock.connect((self.cli_server, self.cli_port))
+        except socket.error:
+            sock.close()
+            raise
+        self._send_buffer_size = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        conn = sock, open_reader(sock)
+        try:
+            send_frame(sock, self.cli_codec.encode('ascii'))
+            with recv_frame(conn[1]) as (data, _):
+                codec = bytes(data).decode('ascii')
+            if codec != self.cli_codec:
+                self._log.info('Server chose codec %r over %r', codec,
+                               self.cli_codec)
+                self.cli_codec = check_codec(codec)
+        except BaseException:
+            self._disconnect(conn)
+            raise
+        return conn
+
+    @staticmethod
+    def _disconnect(conn):
+        """
+        Close a connection from _connect.
+
+        Args:
+            conn (tuple): Socket and reader to close.
+        """
+        sock, reader = conn
+        reader.close()
+        sock.close()
+
+    @staticmethod
+    def _is_stale(conn):
+        """
+        Check whether an idle connection is no good any more, because the
+        server closed it or sent something unasked.
+
+        Args:
+            conn (tuple): Socket and reader from _connect.
+
+        Returns (bool):
+            True if the connection should be thrown away.
+        """
+        if not hasattr(socket, 'MSG_DONTWAIT'):
+            return False
+        sock, _ = conn
+        try:
+            # An idle connection has nothing to read, not even EOF.
+            sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return False
+        except OSError:
+            pass
+        return True
+
+    @staticmethod
+    def _shutdown(sock):
+        """
+        Shut a socket down in both directions, waking up any thread blocked
+        on it.
+
+        Args:
+            sock (socket.socket): Socket to shut down.
+        """
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _exchange(self, conn, frames, results, sent):
+        """
+        Send request frames and wait for all the responses.
+
+        Args:
+            conn (tuple): Socket and reader from _connect.
+            frames (list): (payload, buffers) tuples for the requests.
+            results (list): Deserialized responses are appended to this, in
+                order, as they arrive.
+            sent (list): Appended to once any request may have reached the
+                server in full, after which retrying could run it twice.
+        """
+        sock, reader = conn
+        self._log.debug('Sending %i requests', len(frames))
+        sender = None
+        errors = []
+        if len(frames) == 1:
+            # The server reads a whole request before it answers, so one
+            # request can't get stuck behind its own response.
+            send_frames(sock, frames)
+            sent.append(True)
+        elif _frames_size(frames) < self._send_buffer_size:
+            # Small enough to go straight into the send buffer, so the server
+            # answering early can't block it. If sending fails part way, the
+            # first requests may still have gone out in full.
+            sent.append(True)
+            send_frames(sock, frames)
+        else:
+            # The server answers each request as soon as it has read it, and
+            # reads no more while an answer is waiting to be sent. Send from
+            # another thread and read the answers here, so neither end ends
+            # up blocked sending to the other, whatever the sizes.
+            def send():
+                try:
+                    for frame in frames:
+                        send_frames(sock, [frame])
+                        sent.append(True)
+                except BaseException as error:
+                    errors.append(error)
+                    # Don't leave the reader waiting for answers that won't
+                    # come.
+                    self._shutdown(sock)
+
+            sender = Thread(target=send, daemon=True)
+            sender.start()
+        try:
+            for _ in frames:
+                with recv_frame(reader) as (data, out_of_band):
+                    self._log.debug('Received %i bytes and %i buffers',
+                                    len(data), len(out_of_band))
+                    # Server methods run alongside the server's decodes and
+                    # might switch the collector off themselves, so only the
+                    # client pauses it.
+                    results.append(loads(data, codec=self.cli_codec,
+                                         buffers=out_of_band, pause_gc=True))
+        except BaseException:
+            if sender is not None:
+                # A failed sender records its error before shutting the
+                # socket down, so if there's one now, that's what stopped the
+                # reader. Otherwise the reader failed first, and shutting down
+                # is what stops the sender.
+                sender_failed = bool(errors)
+                self._shutdown(sock)
+                sender.join()
+                if sender_failed:
+                    raise errors[0]
+            raise
+        if sender is not None:
+            sender.join()
+
+    def _encode(self, command, args, kwargs):
+        """
+        Encode a request with the current codec.
+
+        Args:
+            command (str): Method to call.
+            args (tuple): Tuple of positional arguments.
+            kwargs (dict): Dict of keyword arguments.
+
+        Returns (tuple):
+            The encoded request (bytes), and a list of out-of-band buffers
+            (memoryviews) to send with it.
+        """
+        if self._encode_cached is not None:
+            values = tuple(chain(args, kwargs.values()))
+            if _cacheable(values):
+                # Values like these never go out-of-band.
+                return self._encode_cached(
+                    command, args, tuple(kwargs.items()),
+                    tuple(map(type, values)), self.cli_codec,
+                    self.cli_protocol), []
+        buffers = []
+        payload = dumps((command, args, kwargs), codec=self.cli_codec,
+                        protocol=self.cli_protocol, buffers=buffers)
+        return payload, buffers
+
+    def _call(self, calls):
+        """
+        Send requests over an idle connection, or a new one, and collect the
+        responses. The connection goes back in the pool afterwards.
+
+        Args:
+            calls (list): (command, args tuple, kwargs dict) tuples.
+
+        Returns (list):
+            Deserialized responses, in order.
+        """
+        conn = None
+        while self._idle:
+            conn = self._idle.pop()
+            if not self._is_stale(conn):
+                break
+            self._log.debug('Dropping stale connection to %s:%i',
+                            self.cli_server, self.cli_port)
+            self._disconnect(conn)
+            conn = None
+        if conn is None:
+            conn = self._connect()
+        # Encode only once connected, since connecting can change cli_codec.
+        try:
+            frames = [self._encode(*call) for call in calls]
+        except BaseException:
+            self._idle.append(conn)
+            raise
+        results = []
+        sent = []
+        try:
+            try:
+                self._exchange(conn, frames, results, sent)
+            except (socket.error, EOFError):
+                if sent:
+                    # Some calls may already have run, so don't repeat any.
+                    raise
+                # The server never got a whole request, so retry once on a
+                # fresh connection.
+                self._log.debug('Connection to %s:%i lost, reconnecting.',
+                                self.cli_server, self.cli_port, exc_info=True)
+                self._disconnect(conn)
+                conn = self._connect()
+                # The new connection may have settled on another codec.
+                frames = [self._encode(*call) for call in calls]
+                self._exchange(conn, frames, results, sent)
+        except BaseException:
+            # Whatever went wrong, the connection is in an unknown state.
+            self._disconnect(conn)
+            raise
+        self._idle.append(conn)
+        return results
+
+    def close(self):
+        """Close the idle connections to the server. The next call reconnects."""
+        while self._idle:
+            self._disconnect(self._idle.pop())
 
     def _setup_obj(self):
         """Dynamically assign the methods from the server to this instance."""
-        self._log.debug(locals())
         # Register remote methods
         methods = self._send_command('_ext_methods')
+        existing = set(dir(self))
         for method, docstring in methods:
-            if method in dir(self):
+            if method in existing:
                 self._log.warning('Method already exists: %s', method)
             else:
                 self._log.debug('Creating method: %s', method)
                 setattr(self, method, self._method_call(method, docstring))
+                existing.add(method)
 
     def _method_call(self, method_name, docstring=''):
         """
@@ -56,12 +383,10 @@ class PickleRpcClient:
                 empty string.
             called (bool): Is this a callable method or a property?
 
-        Returns (func):
+        Returns (functools.partial):
             Wrapped method.
         """
-        def wrapped_method(*args, **kwargs):
-            return self._send_command(method_name, *args, **kwargs)
-        
+        wrapped_method = partial(self._send_command, method_name)
         wrapped_method.__doc__ = docstring
         return wrapped_method
 
@@ -80,31 +405,47 @@ class PickleRpcClient:
         Raises:
             Exception: If the method returned an exception object, raise it.
         """
-        self._log.debug(locals())
-        self._log.debug(
-            'Remote calling %s(%s) on %s:%i',
-            command,
-            ', '.join(
-                [repr(a) for a in args] + ['{}={}'.format(k, repr(v)) for k, v in kwargs.items()]
-            ),
-            self.cli_server,
-            self.cli_port,
-        )
-        payload = {'command': command, 'args': args, 'kwargs': kwargs}
-        payload = pickle.dumps(payload, protocol=self.cli_protocol)
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            self._log.debug('Connecting to %s:%i', self.cli_server,
-                            self.cli_port)
-            sock.connect((self.cli_server, self.cli_port))
-            send_cmd = payload
-            self._log.debug('Sending:\n\n%r\n', send_cmd)
-            sock.sendall(send_cmd)
-            data = sock.recv(4096)
-            self._log.debug('Received:\n\n%r\n', data)
-        # Process the data
-        o_data = pickle.loads(data)
-        self._log.debug('Loaded %s: %r', type(o_data), o_data)
+        debug = self._log.isEnabledFor(logging.DEBUG)
+        if debug:
+            self._log.debug(
+                'Remote calling %s(%s) on %s:%i',
+                command,
+                ', '.join(chain(
+                    map(repr, args),
+                    ('{}={!r}'.format(k, v) for k, v in kwargs.items()),
+                )),
+                self.cli_server,
+                self.cli_port,
+            )
+        o_data, = self._call([(command, args, kwargs)])
+        if debug:
+            self._log.debug('Loaded %s: %r', type(o_data), o_data)
         # Raise if this is an exception.
         if isinstance(o_data, Exception):
             raise o_data
         return o_data
+
+    def pipeline(self, calls):
+        """
+        Make several remote calls without waiting for each answer before
+        sending the next request, saving a round trip per call.
+
+        Args:
+            calls (list): (method name, args tuple, kwargs dict) tuples.
+
+        Returns (list):
+            What each method returned, in order.
+
+        Raises:
+            Exception: If any method returned an exception object, the first
+                one is raised once all the calls are done.
+        """
+        self._log.debug('Pipelining %i calls to %s:%i', len(calls),
+                        self.cli_server, self.cli_port)
+        results = self._call([
+            (command, tuple(args), dict(kwargs))
+            for command, args, kwargs in calls])
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
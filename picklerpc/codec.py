@@ -0,0 +1,239 @@
+"""
+picklerpc Codec
+Author: Josh Schneider (josh.schneider@gmail.com)
+"""
+
+import builtins
+import gc
+import pickle
+import threading
+
+try:
+    # The C accelerator, bound directly so the hot path skips the module
+    # attribute lookups.
+    from _pickle import dumps as _pickle_dumps, loads as _pickle_loads
+except ImportError:
+    from pickle import dumps as _pickle_dumps, loads as _pickle_loads
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+CODECS = ('pickle', 'msgpack')
+
+# The codecs that work here, which a server offers to its clients.
+AVAILABLE_CODECS = tuple(
+    codec for codec in CODECS if codec != 'msgpack' or msgspec is not None)
+
+# Binary pickle protocols are smaller and faster than the default, so use the
+# best one available unless told otherwise.
+_PICKLE_PROTO = pickle.HIGHEST_PROTOCOL
+
+# Payloads bigger than this are decoded with the garbage collector paused.
+_GC_PAUSE_SIZE = 4096
+# How many decodes have the collector paused right now. Only the first one in
+# pauses it and only the last one out resumes it, under the lock.
+_gc_pauses = 0
+_gc_lock = threading.Lock()
+
+# With pickle protocol 5, contiguous buffers (bytearrays, NumPy arrays, ...) at
+# least this big are sent out-of-band instead of copied into the pickle.
+_OUT_OF_BAND_SIZE = 64 * 1024
+
+# Exception arguments of these types are sent along so msgpack can rebuild the
+# exception as it was raised.
+_PLAIN_TYPES = (str, bytes, int, float, bool, type(None))
+
+
+class RemoteError(Exception):
+    """Raised for a remote exception that can't be rebuilt locally."""
+
+
+def _exc_to_msgpack(obj):
+    """
+    Encode hook for msgpack. Exceptions can't be carried natively, so send the
+    type name and message instead, plus the arguments when they're all plain
+    values.
+
+    Args:
+        obj (object): Object msgpack doesn't know how to encode.
+
+    Returns (dict):
+        Encodable stand-in for the exception.
+
+    Raises:
+        NotImplementedError: If obj isn't an exception.
+    """
+    if isinstance(obj, Exception):
+        encoded = {'__exc__': type(obj).__name__, 'msg': str(obj)}
+        if all(isinstance(arg, _PLAIN_TYPES) for arg in obj.args):
+            encoded['args'] = list(obj.args)
+        return encoded
+    raise NotImplementedError('Cannot encode {} with msgpack'.format(type(obj)))
+
+
+def _exc_from_msgpack(obj):
+    """
+    Rebuild an exception encoded by _exc_to_msgpack.
+
+    Args:
+        obj (object): Decoded msgpack object.
+
+    Returns (object):
+        An exception instance if obj was an encoded exception, otherwise obj.
+        Exceptions that aren't builtins, or can't be rebuilt from what was
+        sent, come back as RemoteError.
+    """
+    if not isinstance(obj, dict) or '__exc__' not in obj:
+        return obj
+    exc_type = getattr(builtins, obj['__exc__'], None)
+    if isinstance(exc_type, type) and issubclass(exc_type, Exception):
+        try:
+            if 'args' in obj:
+                return exc_type(*obj['args'])
+            return exc_type(obj['msg'])
+        except Exception:
+            pass
+    return RemoteError('{}: {}'.format(obj['__exc__'], obj['msg']))
+
+
+if msgspec is not None:
+    _msgpack_encoder = msgspec.msgpack.Encoder(enc_hook=_exc_to_msgpack)
+    _msgpack_decoder = msgspec.msgpack.Decoder()
+
+
+def check_codec(codec):
+    """
+    Make sure a codec name is known and usable.
+
+    Args:
+        codec (str): Codec name.
+
+    Returns (str):
+        The codec name.
+
+    Raises:
+        ValueError: If the codec is unknown.
+        ImportError: If the codec needs a package that isn't installed.
+    """
+    if codec not in CODECS:
+        raise ValueError('Unknown codec {!r}, expected one of {}'.format(codec, CODECS))
+    if codec == 'msgpack' and msgspec is None:
+        raise ImportError('The msgpack codec requires msgspec to be installed.')
+    return codec
+
+
+def dumps(obj, codec='pickle', protocol=None, buffers=None):
+    """
+    Serialize an object.
+
+    Args:
+        obj (object): Object to serialize.
+        codec (str): Codec name. Defaults to pickle.
+        protocol (int): Pickle protocol, ignored by msgpack. Defaults to None
+            (highest available).
+        buffers (list): If given, and the pickle protocol is 5 or higher,
+            large buffers in obj are appended to it as memoryviews instead of
+            being copied into the result. Send them along and pass them to
+            loads(). Defaults to None.
+
+    Returns (bytes):
+        Serialized object.
+    """
+    if codec == 'msgpack':
+        return _msgpack_encoder.encode(obj)
+    protocol = _PICKLE_PROTO if protocol is None else protocol
+    # pickle.dumps writes to its own internal buffer in C. Reusing a Pickler
+    # over a pooled BytesIO measured well over twice as slow for RPC-sized
+    # payloads, so don't.
+    if buffers is None or protocol < 5:
+        return _pickle_dumps(obj, protocol=protocol)
+
+    def out_of_band(pickle_buffer):
+        """Keep big contiguous buffers out of band; returning True pickles in-band."""
+        try:
+            view = pickle_buffer.raw()
+        except BufferError:
+            return True
+        if view.nbytes < _OUT_OF_BAND_SIZE:
+            return True
+        buffers.append(view)
+        return False
+
+    return _pickle_dumps(obj, protocol=protocol, buffer_callback=out_of_band)
+
+
+def _decode(data, codec, buffers):
+    """
+    Deserialize an object, without any GC handling.
+
+    Args:
+        data (bytes): Serialized object.
+        codec (str): Codec name.
+        buffers (list): Out-of-band buffers from dumps().
+
+    Returns (object):
+        Deserialized object.
+    """
+    if codec == 'msgpack':
+        return _exc_from_msgpack(_msgpack_decoder.decode(data))
+    # Same for pickle.loads versus an Unpickler over a BytesIO.
+    if buffers:
+        return _pickle_loads(data, buffers=buffers)
+    return _pickle_loads(data)
+
+
+def _pause_gc():
+    """
+    Pause the garbage collector for a decode, unless it's off already.
+
+    Returns (bool):
+        True if the decode joined the pause, and must call _resume_gc after.
+    """
+    global _gc_pauses
+    with _gc_lock:
+        if not _gc_pauses:
+            if not gc.isenabled():
+                # Turned off by someone else; leave it to them.
+                return False
+            gc.disable()
+        _gc_pauses += 1
+        return True
+
+
+def _resume_gc():
+    """Leave a pause started by _pause_gc, resuming collection if it's the last."""
+    global _gc_pauses
+    with _gc_lock:
+        _gc_pauses -= 1
+        if not _gc_pauses:
+            gc.enable()
+
+
+def loads(data, codec='pickle', buffers=(), pause_gc=False):
+    """
+    Deserialize an object.
+
+    Decoding a large payload allocates lots of containers, which would set off
+    garbage collections partway through. None of them can be garbage yet, so
+    the collector can be paused while large payloads decode. It's paused for
+    the whole process, so only do that where no other code might turn it off
+    or on meanwhile.
+
+    Args:
+        data (bytes): Serialized object.
+        codec (str): Codec name. Defaults to pickle.
+        buffers (list): Out-of-band buffers from dumps(). Defaults to none.
+        pause_gc (bool): Pause the garbage collector while decoding a large
+            payload. Defaults to False.
+
+    Returns (object):
+        Deserialized object.
+    """
+    if not pause_gc or len(data) <= _GC_PAUSE_SIZE or not _pause_gc():
+        return _decode(data, codec, buffers)
+    try:
+        return _decode(data, codec, buffers)
+    finally:
+        _resume_gc()
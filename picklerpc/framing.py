@@ -0,0 +1,303 @@
+"""
+picklerpc Framing
+Author: Josh Schneider (josh.schneider@gmail.com)
+"""
+
+import asyncio
+import queue
+import struct
+
+from contextlib import contextmanager
+
+# Every frame on the wire starts with a header of two 4-byte big-endian
+# unsigned ints: the payload length, and how many buffer frames follow it.
+# Buffers carry out-of-band data (pickle protocol 5) so large binary values
+# don't get copied into the payload. Buffer frames never have buffers of their
+# own.
+_HEADER = struct.Struct('>II')
+
+# Send and receive buffers are pooled and reused across messages. Frames
+# bigger than this get a one-off buffer instead.
+_POOLED_SIZE = 64 * 1024
+_pool = queue.SimpleQueue()
+
+
+def _get_buffer(size):
+    """
+    Get a buffer of at least size bytes, from the pool if possible.
+
+    Args:
+        size (int): Minimum buffer size.
+
+    Returns (bytearray):
+        Buffer to use. Hand it back with _put_buffer when done.
+    """
+    if size > _POOLED_SIZE:
+        return bytearray(size)
+    try:
+        return _pool.get_nowait()
+    except queue.Empty:
+        return bytearray(_POOLED_SIZE)
+
+
+def _put_buffer(buf):
+    """
+    Return a buffer to the pool.
+
+    Args:
+        buf (bytearray): Buffer from _get_buffer.
+    """
+    if len(buf) == _POOLED_SIZE:
+        _pool.put(buf)
+
+
+# Most pieces a single sendmsg call may be given (the smallest common IOV_MAX).
+_IOV_MAX = 1024
+
+
+def _sendmsg_all(sock, views):
+    """
+    Send a list of buffers with as few sendmsg calls as possible.
+
+    Args:
+        sock (socket.socket): Connected socket to send on.
+        views (list): Memoryviews (of bytes) to send, in order.
+    """
+    start = 0
+    while start < len(views):
+        sent = sock.sendmsg(views[start:start + _IOV_MAX])
+        # Skip whatever went out in full, and send the rest of a partly sent
+        # view next time around.
+        while start < len(views) and sent >= views[start].nbytes:
+            sent -= views[start].nbytes
+            start += 1
+        if sent:
+            views[start] = views[start][sent:]
+
+
+def _frame_views(payload, buffers):
+    """
+    Lay out a frame as a list of memoryviews for sendmsg, without copying the
+    payload or buffers.
+
+    Args:
+        payload (bytes): Data to send.
+        buffers (list): Out-of-band buffers (memoryviews) to send after it.
+
+    Returns (list):
+        Memoryviews to send, in order.
+    """
+    # All the headers are packed into one buffer up front.
+    headers = memoryview(bytearray(_HEADER.size * (len(buffers) + 1)))
+    _HEADER.pack_into(headers, 0, len(payload), len(buffers))
+    views = [headers[:_HEADER.size], memoryview(payload).cast('B')]
+    for index, data in enumerate(buffers, 1):
+        offset = index * _HEADER.size
+        _HEADER.pack_into(headers, offset, data.nbytes, 0)
+        views.append(headers[offset:offset + _HEADER.size])
+        views.append(memoryview(data).cast('B'))
+    return views
+
+
+def _send_frame_copy(sock, payload, buffers):
+    """
+    Send a frame without sendmsg, copying the header and payload together
+    into a pooled buffer.
+
+    Args:
+        sock (socket.socket): Connected socket to send on.
+        payload (bytes): Data to send.
+        buffers (list): Out-of-band buffers (memoryviews) to send after it.
+    """
+    size = _HEADER.size + len(payload)
+    buf = _get_buffer(size)
+    try:
+        _HEADER.pack_into(buf, 0, len(payload), len(buffers))
+        buf[_HEADER.size:size] = payload
+        with memoryview(buf) as view:
+            sock.sendall(view[:size])
+    finally:
+        _put_buffer(buf)
+    for data in buffers:
+        sock.sendall(_HEADER.pack(data.nbytes, 0))
+        sock.sendall(data)
+
+
+def send_frame(sock, payload, buffers=()):
+    """
+    Send a length-prefixed frame.
+
+    Args:
+        sock (socket.socket): Connected socket to send on.
+        payload (bytes): Data to send.
+        buffers (list): Out-of-band buffers (memoryviews) to send after the
+            payload, without copying them. Defaults to none.
+    """
+    send_frames(sock, [(payload, buffers)])
+
+
+def send_frames(sock, frames):
+    """
+    Send several length-prefixed frames back to back.
+
+    Args:
+        sock (socket.socket): Connected socket to send on.
+        frames (list): (payload, buffers) tuples, as for send_frame.
+    """
+    if hasattr(sock, 'sendmsg'):
+        # Gather the headers, payloads and buffers into one write, rather
+        # than copying them together or sending each on its own.
+        views = []
+        for payload, buffers in frames:
+            views.extend(_frame_views(payload, buffers))
+        _sendmsg_all(sock, views)
+        return
+    for payload, buffers in frames:
+        _send_frame_copy(sock, payload, buffers)
+
+
+def open_reader(sock):
+    """
+    Open a buffered reader on a socket to receive frames from. Small frames
+    then arrive header and payload together in a single recv call.
+
+    Args:
+        sock (socket.socket): Connected socket to receive on.
+
+    Returns (io.BufferedReader):
+        Reader for recv_frame. Close it before closing the socket.
+    """
+    return sock.makefile('rb', buffering=_POOLED_SIZE)
+
+
+def _recv_into(reader, view):
+    """
+    Fill a memoryview with bytes from a reader.
+
+    Args:
+        reader (io.BufferedReader): Reader from open_reader.
+        view (memoryview): Writable view to fill.
+
+    Raises:
+        EOFError: If the connection closes before the view is full.
+    """
+    # A buffered reader keeps reading until the view is full or it hits EOF.
+    count = reader.readinto(view)
+    if count < len(view):
+        raise EOFError(
+            'Connection closed after {} of {} bytes.'.format(count, len(view)))
+
+
+def _recv_buffer(reader, header):
+    """
+    Receive an out-of-band buffer frame into a buffer of its own.
+
+    Args:
+        reader (io.BufferedReader): Reader from open_reader.
+        header (memoryview): Writable view to read the frame header into.
+
+    Returns (bytearray):
+        The buffer contents.
+
+    Raises:
+        EOFError: If the connection closes before the whole frame arrives.
+    """
+    _recv_into(reader, header)
+    size, _ = _HEADER.unpack(header)
+    # Decoded objects keep using this memory, so it can't come from the pool.
+    buf = bytearray(size)
+    with memoryview(buf) as view:
+        _recv_into(reader, view)
+    return buf
+
+
+@contextmanager
+def recv_frame(reader):
+    """
+    Receive a length-prefixed frame into a pooled buffer, along with any
+    out-of-band buffers sent with it.
+
+    The payload is only valid inside the with block; decode it there.
+
+    Args:
+        reader (io.BufferedReader): Reader from open_reader.
+
+    Yields (tuple):
+        The frame payload (memoryview), without the length header, and a
+        list of out-of-band buffers (bytearray).
+
+    Raises:
+        EOFError: If the connection closes before the whole frame arrives.
+    """
+    buf = _get_buffer(_HEADER.size)
+    try:
+        with memoryview(buf) as view:
+            _recv_into(reader, view[:_HEADER.size])
+        size, count = _HEADER.unpack_from(buf)
+        if size > len(buf):
+            # Hand the small buffer back only once the big one exists, or a
+            # failed allocation would put it back twice in the finally below.
+            big = _get_buffer(size)
+            _put_buffer(buf)
+            buf = big
+        with memoryview(buf) as view:
+            frame = view[:size]
+            _recv_into(reader, frame)
+            buffers = []
+            if count:
+                # One header buffer does for all the buffer frames.
+                header = memoryview(bytearray(_HEADER.size))
+                buffers = [_recv_buffer(reader, header) for _ in range(count)]
+            try:
+                yield frame, buffers
+            finally:
+                frame.release()
+    finally:
+        _put_buffer(buf)
+
+
+async def read_frame(reader):
+    """
+    Receive a length-prefixed frame from an asyncio stream.
+
+    Args:
+        reader (asyncio.StreamReader): Stream to receive on.
+
+    Returns (tuple):
+        The frame payload (bytes), without the length header, and a list of
+        out-of-band buffers (bytearray), writable like recv_frame's.
+
+    Raises:
+        EOFError: If the connection closes before the whole frame arrives.
+    """
+    try:
+        size, count = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+        payload = await reader.readexactly(size)
+        buffers = []
+        for _ in range(count):
+            size, _ = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+            buffers.append(bytearray(await reader.readexactly(size)))
+        return payload, buffers
+    except asyncio.IncompleteReadError as error:
+        raise EOFError(
+            'Connection closed after {} of {} bytes.'.format(
+                len(error.partial), error.expected)) from None
+
+
+def write_frame(writer, payload, buffers=()):
+    """
+    Queue a length-prefixed frame on an asyncio stream. Await
+    writer.drain() afterwards.
+
+    Args:
+        writer (asyncio.StreamWriter): Stream to send on.
+        payload (bytes): Data to send.
+        buffers (list): Out-of-band buffers (memoryviews) to send after the
+            payload. Defaults to none.
+    """
+    pieces = [_HEADER.pack(len(payload), len(buffers)), payload]
+    for data in buffers:
+        pieces.append(_HEADER.pack(data.nbytes, 0))
+        pieces.append(data)
+    # Transports that support it send these with a single sendmsg call.
+    writer.writelines(pieces)
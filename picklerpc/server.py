@@ -3,32 +3,123 @@ picklerpc Server
 Author: Josh Schneider (josh.schneider@gmail.com)
 """
 
+import asyncio
+import inspect
 import logging
+import os
 import pickle
 import socket
-import time
+import threading
 
-from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import chain
+
+from picklerpc.codec import AVAILABLE_CODECS, RemoteError, check_codec, dumps, loads
+from picklerpc.framing import read_frame, write_frame
+
+
+@lru_cache(maxsize=None)
+def _get_fqdn():
+    """
+    Look up the fully qualified domain name of this host. This can mean a
+    slow DNS lookup, so it is only done once, the first time it is needed.
+
+    Returns (str):
+        The host's FQDN.
+    """
+    return socket.getfqdn()
+
+
+# The server a worker process answers requests with, set by _init_worker.
+_worker_server = None
+
+
+def _init_worker(server):
+    """
+    Set up a worker process of a server's process pool. The server is handed
+    over once here, rather than with every request.
+
+    Args:
+        server (PickleRpcServer): Copy of the server to answer requests with.
+    """
+    global _worker_server
+    _worker_server = server
+
+
+def _respond_in_worker(data, buffers, codec):
+    """
+    Answer an encoded request in a worker process.
+
+    Args:
+        data (bytes): Encoded request.
+        buffers (list): Out-of-band buffers sent with the request.
+        codec (str): Codec name for the connection.
+
+    Returns (tuple):
+        The encoded response (bytes), and an empty list, since memoryviews
+        can't be sent back from another process.
+    """
+    return _worker_server._respond(data, buffers, codec, False)
 
 
 class PickleRpcServer:
     """Pickle RPC Server. Subclass, add your own methods, and watch it go!"""
 
-    def __init__(self, host='0.0.0.0', port=62000, protocol=None):
+    def __init__(self, host='0.0.0.0', port=62000, protocol=None, codec='pickle',
+                 max_workers=None, executor=None, processes=None):
         """
         Prepare a PickleRpcServer instance for use.
 
         Args:
             host (str): Hostname to bind to. Defaults to empty string (all
                 hosts).
-            port (int): Port to bind to. Defaults to 62000.
+            port (int): Port to bind to, or 0 for any free port. svr_port is
+                set to the bound port while running. Defaults to 62000.
+            protocol (int): Pickle protocol to use. Defaults to None (highest
+                available).
+            codec (str): Serialization codec, 'pickle' or 'msgpack', for
+                clients that ask for one this server can't use. Otherwise
+                each client gets the one it asks for. Defaults to 'pickle'.
+            max_workers (int): Number of method calls to run at once. Defaults
+                to None (4 per CPU).
+            executor (concurrent.futures.Executor): Executor to run method
+                calls in instead of the server's own thread pool, such as a
+                ProcessPoolExecutor. max_workers is ignored if this is given.
+                Defaults to None.
+            processes (int): Number of worker processes to run method calls
+                in, for CPU-bound methods. Each gets its own copy of the
+                server when it starts, so the server must be picklable.
+                max_workers and executor are ignored if this is given.
+                Defaults to None (run them in threads).
         """
         self._log = logging.getLogger('picklerpc.{}'.format(self.__class__.__name__))
-        self.svr_fqdn = socket.getfqdn()
         self.svr_host = host
         self.svr_port = int(port)
-        self.svr_protocol = protocol
+        self._bind_port = self.svr_port
+        self.svr_protocol = pickle.HIGHEST_PROTOCOL if protocol is None else int(protocol)
+        self.svr_codec = check_codec(codec)
+        self.svr_max_workers = max_workers or (os.cpu_count() or 1) * 4
         self.svr_running = False
+        # Set by assigning svr_fqdn; looked up on first use otherwise.
+        self._fqdn = None
+        # Set alongside svr_running, for threads waiting on the server.
+        self._ready = threading.Event()
+        self._executor = executor
+        self.svr_processes = processes
+        # Set while run() is serving with worker processes.
+        self._workers = None
+        self._conns = set()
+        # Set while run() is serving, so stop() can reach it.
+        self._loop = None
+        self._stopping = None
+        self._requests_left = None
+        # Filled in by _scan() on first use, once subclass __init__ has
+        # finished.
+        self._ext_methods_cache = None
+        self._ext_methods_encoded = {}
+        self._method_table = {}
+        self._prop_names = frozenset()
 
     def __str__(self):
         """Displays detailed information with str()."""
@@ -39,28 +130,74 @@ class PickleRpcServer:
             '\n'.join('  {}'.format(m) for m in self._ext_methods),
         )
 
+    @property
+    def svr_fqdn(self):
+        """Fully qualified domain name of this host, unless set otherwise."""
+        if self._fqdn is None:
+            return _get_fqdn()
+        return self._fqdn
+
+    @svr_fqdn.setter
+    def svr_fqdn(self, value):
+        """Override the looked up name, as subclasses used to be able to."""
+        self._fqdn = value
+
+    def __getstate__(self):
+        """
+        Leave out the running server's state when pickled, so methods can be
+        run in a process pool.
+        """
+        state = self.__dict__.copy()
+        state.update(_executor=None, _workers=None, _ready=None, _conns=set(),
+                     _loop=None, _stopping=None)
+        return state
+
     @property
     def _dict(self):
         """Dictionary of non-protected properties."""
-        return {
-            k: getattr(self, k)
-            for k in dir(self)
-            if not k.startswith('_') and not callable(getattr(self, k))
-        }
+        if self._ext_methods_cache is None:
+            self._scan()
+        return {k: getattr(self, k) for k in sorted(self._prop_names)}
 
     @property
     def _ext_methods(self):
         """
-        List of methods that should be externally accessible (public, and not
-        run()).
+        Methods that should be externally accessible (public, and not run(),
+        stop() or wait_until_ready()).
+        """
+        if self._ext_methods_cache is None:
+            self._scan()
+        return self._ext_methods_cache
+
+    def _scan(self):
+        """
+        Work out the externally accessible methods and properties, and build
+        the dispatch table for them. Done once and cached, since they don't
+        change after __init__. Subclasses that add members to an instance
+        later must call this again to expose them.
         """
-        return [
-            (i, getattr(self, i).__doc__)
-            for i in dir(self)
-            if i not in ['run'] and not i.startswith('_') and callable(getattr(self, i))
-        ]
+        methods = {}
+        props = set()
+        for name in dir(self):
+            if name in ['run', 'stop', 'wait_until_ready'] or name.startswith('_'):
+                continue
+            # Look members up without running descriptors, so properties
+            # aren't evaluated (svr_fqdn does a DNS lookup, for one).
+            member = inspect.getattr_static(self, name)
+            if isinstance(member, (staticmethod, classmethod)) or callable(member):
+                methods[name] = getattr(self, name)
+            else:
+                props.add(name)
+        self._method_table = methods
+        self._prop_names = frozenset(props)
+        self._ext_methods_cache = tuple(
+            (name, inspect.getdoc(method)) for name, method in methods.items())
+        self._ext_methods_encoded = {
+            codec: dumps(self._ext_methods_cache, codec=codec,
+                         protocol=self.svr_protocol)
+            for codec in AVAILABLE_CODECS}
 
-    def _get_result(self, command=None, args=None, kwargs=None):
+    def _get_result(self, command, args, kwargs):
         """
         Get a result from a local method.
 
@@ -73,70 +210,281 @@ class PickleRpcServer:
             Returns whatever the method returns, or an exception object if an
             exception occurs.
         """
-        self._log.info(
-            'Getting: %s(%s)', command,
-            ', '.join(
-                [repr(a) for a in args] + ['{}={}'.format(k, repr(v)) for k, v in kwargs.items()]
+        # Only repr the arguments if the line will be logged; they can be big.
+        if self._log.isEnabledFor(logging.INFO):
+            self._log.info(
+                'Getting: %s(%s)', command,
+                ', '.join(chain(
+                    map(repr, args),
+                    ('{}={!r}'.format(k, v) for k, v in kwargs.items()),
+                ))
             )
-        )
+        if self._ext_methods_cache is None:
+            self._scan()
         try:
-            member = getattr(self, command)
-            return member(*args, **kwargs) if callable(member) else member
+            method = self._method_table.get(command)
+            if method is not None:
+                return method(*args, **kwargs)
+            # Clients ask for _ext_methods to find out what they can call.
+            if command in self._prop_names or command == '_ext_methods':
+                return getattr(self, command)
+            raise AttributeError('{} has no external method or property {!r}'.format(
+                self.__class__.__name__, command))
         except Exception as error:
             self._log.error(
                 'ERROR getting attribute %s', command, exc_info=True)
             return error
 
-    def run(self, timeout=None):
+    def _respond(self, data, buffers, codec, out_of_band):
         """
-        Run the server.
+        Answer an encoded request with an encoded response.
 
         Args:
-            timeout (int): Number of seconds to run for. Defaults to None (
-                run indefinitely).
-        """
-        self._log.debug('Running %r with timeout=%r', self, timeout)
-
-        # Set the stopper.
-        stop_time = time.time() + timeout if timeout else None
-        
-        def stopper():
-            return bool(time.time() < stop_time) if timeout else False
-
-        # Open the socket for use.
-        with closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
-            sock.settimeout(5)
-            self._log.info('Listening on %s:%i', self.svr_host, self.svr_port)
-            sock.bind((self.svr_host, self.svr_port))
-            self.svr_running = True
-            # Loop
-            while stopper():
+            data (bytes): Encoded request.
+            buffers (list): Out-of-band buffers sent with the request.
+            codec (str): Codec name for the connection.
+            out_of_band (bool): Whether the response may use out-of-band
+                buffers.
+
+        Returns (tuple):
+            The encoded response (bytes), and a list of out-of-band buffers
+            (memoryviews) to send with it.
+        """
+        try:
+            command, args, kwargs = loads(data, codec=codec, buffers=buffers)
+        except Exception as error:
+            self._log.error('ERROR decoding request', exc_info=True)
+            return self._encode_error(error, codec), []
+        self._log.debug('Received %r, %r, %r', command, args, kwargs)
+        if command == '_ext_methods':
+            # Every client asks for this first, and it never changes, so send
+            # the copy encoded by _scan().
+            return self._ext_methods_encoded[codec], []
+        val = self._get_result(command, args, kwargs)
+        self._log.debug('Packaging %s for return', type(val))
+        buffers = [] if out_of_band else None
+        try:
+            retval = dumps(val, codec=codec, protocol=self.svr_protocol,
+                           buffers=buffers)
+        except Exception as error:
+            self._log.error('ERROR encoding result of %s', command,
+                            exc_info=True)
+            return self._encode_error(error, codec), []
+        return retval, buffers or []
+
+    def _encode_error(self, error, codec):
+        """
+        Encode an exception to send back in place of a response, so the
+        client raises it.
+
+        Args:
+            error (Exception): Exception to send.
+            codec (str): Codec name for the connection.
+
+        Returns (bytes):
+            Encoded exception, or an encoded RemoteError describing it if it
+            can't be encoded itself.
+        """
+        try:
+            return dumps(error, codec=codec, protocol=self.svr_protocol)
+        except Exception:
+            return dumps(
+                RemoteError('{}: {}'.format(type(error).__name__, error)),
+                codec=codec, protocol=self.svr_protocol)
+
+    async def _negotiate(self, reader, writer):
+        """
+        Agree on a codec with a newly connected client. The client sends the
+        name of the codec it wants, and gets back the name of the one to use.
+
+        Args:
+            reader (asyncio.StreamReader): Stream from the client.
+            writer (asyncio.StreamWriter): Stream to the client.
+
+        Returns (str):
+            Codec name to use on this connection.
+
+        Raises:
+            EOFError: If the client hangs up first.
+        """
+        data, _ = await read_frame(reader)
+        codec = data.decode('ascii', 'replace')
+        if codec not in AVAILABLE_CODECS:
+            self._log.info('Client asked for codec %r, using %r', codec,
+                           self.svr_codec)
+            codec = self.svr_codec
+        write_frame(writer, codec.encode('ascii'))
+        await writer.drain()
+        return codec
+
+    async def _handle(self, reader, writer):
+        """
+        Answer requests on a client connection until the client hangs up.
+
+        Args:
+            reader (asyncio.StreamReader): Stream from the client.
+            writer (asyncio.StreamWriter): Stream to the client.
+        """
+        addr = writer.get_extra_info('peername')
+        # Responses are often tiny; send them right away rather than letting
+        # Nagle's algorithm hold them back. asyncio's own loop does this
+        # already, but not every loop implementation does.
+        writer.get_extra_info('socket').setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        loop = asyncio.get_running_loop()
+        self._conns.add(writer)
+        try:
+            try:
+                codec = await self._negotiate(reader, writer)
+            except EOFError:
+                self._log.debug('Connection from %s closed', addr)
+                return
+            while True:
                 try:
-                    try:
-                        sock.listen(0)
-                        conn, addr = sock.accept()
-                        self._log.debug('--- Got something ---')
-                        with closing(conn):
-                            data = conn.recv(4096)
-                            self._log.debug('Received data from %s:\n\n%r\n',
-                                            addr, data)
-                            payload = pickle.loads(data)
-                            self._log.debug('Received %r', payload)
-                            val = self._get_result(**payload)
-                            self._log.debug('Packaging %s for return',
-                                            type(val))
-                            retval = pickle.dumps(
-                                val, protocol=self.svr_protocol)
-                            self._log.debug('Sending:\n\n%r\n', retval)
-                            conn.sendall(retval)
-                    except socket.timeout:
-                        pass
-                    except socket.error:
-                        self._log.error(
-                            'ERROR getting or sending data.', exc_info=True)
-                except KeyboardInterrupt:
-                    self._log.debug('Stopping.')
+                    data, buffers = await read_frame(reader)
+                except EOFError:
+                    self._log.debug('Connection from %s closed', addr)
                     break
+                self._log.debug('Received %i bytes from %s', len(data), addr)
+                # Decoding, the method call and encoding are all blocking
+                # work, so do them in the executor and keep the event loop
+                # free for network I/O. Memoryviews can't be sent back from
+                # another process, so only the server's own thread pool gets
+                # out-of-band buffers in responses.
+                try:
+                    if self._workers is not None:
+                        retval, buffers = await loop.run_in_executor(
+                            self._workers, _respond_in_worker, data, buffers,
+                            codec)
+                    else:
+                        retval, buffers = await loop.run_in_executor(
+                            self._executor, self._respond, data, buffers,
+                            codec, self._executor is None)
+                except Exception as error:
+                    # The executor couldn't run it at all. Answer anyway, so
+                    # the client doesn't wait forever or send it again.
+                    self._log.error('ERROR running request from %s', addr,
+                                    exc_info=True)
+                    retval, buffers = self._encode_error(error, codec), []
+                self._log.debug('Sending:\n\n%r\n', retval)
+                write_frame(writer, retval, buffers)
+                await writer.drain()
+                if self._requests_left is not None:
+                    self._requests_left -= 1
+                    if self._requests_left <= 0:
+                        self._stopping.set()
+        except socket.error:
+            self._log.error('ERROR getting or sending data.', exc_info=True)
+        finally:
+            self._conns.discard(writer)
+            writer.close()
+
+    async def _serve(self, timeout, max_requests):
+        """
+        Serve clients until the timeout runs out, max_requests have been
+        answered, or stop() is called.
+
+        Args:
+            timeout (int): Number of seconds to run for, or None to run until
+                stopped.
+            max_requests (int): Number of requests to answer, or None for no
+                limit.
+        """
+        loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._requests_left = max_requests
+        self._loop = loop
+        loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=self.svr_max_workers))
+        server = await asyncio.start_server(
+            self._handle, self.svr_host, self._bind_port, backlog=128,
+            reuse_address=True)
+        # Port 0 picks a free port; report which one.
+        self.svr_port = server.sockets[0].getsockname()[1]
+        self._log.info('Listening on %s:%i', self.svr_host, self.svr_port)
+        self.svr_running = True
+        self._ready.set()
+        try:
+            async with server:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout or None)
+                except asyncio.TimeoutError:
+                    pass
+                # Hang up on anyone still connected.
+                for writer in list(self._conns):
+                    writer.close()
+        finally:
             self._log.info('Stopped listening on %s:%i', self.svr_host,
                            self.svr_port)
             self.svr_running = False
+            self._ready.clear()
+            self._loop = None
+
+    def wait_until_ready(self, timeout=None):
+        """
+        Wait for the server to start listening. Safe to call from any thread.
+
+        Args:
+            timeout (float): Number of seconds to wait at most. Defaults to
+                None (wait until it starts).
+
+        Returns (bool):
+            True if the server is running, False if the timeout ran out first.
+        """
+        return self._ready.wait(timeout)
+
+    def stop(self):
+        """Stop the server if it's running. Safe to call from any thread."""
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            loop.call_soon_threadsafe(self._stopping.set)
+        except RuntimeError:
+            # The loop closed in the meantime; the server already stopped.
+            pass
+
+    def run(self, timeout=None, max_requests=None):
+        """
+        Run the server.
+
+        The server runs on an asyncio event loop from the current event loop
+        policy, so installing a faster loop first (uvloop.install(), for
+        instance) speeds it up with no other changes.
+
+        Args:
+            timeout (int): Number of seconds to run for. Defaults to None (
+                run until stop() is called).
+            max_requests (int): Number of requests to answer before stopping.
+                Each new client asks for the method list first, which counts.
+                Defaults to None (no limit).
+        """
+        self._log.debug('Running %r with timeout=%r, max_requests=%r', self,
+                        timeout, max_requests)
+
+        # Work out the external methods up front, not on the first request.
+        if self._ext_methods_cache is None:
+            self._scan()
+
+        if self.svr_processes or isinstance(self._executor, ProcessPoolExecutor):
+            # Worker processes get a pickled copy of the server, so fail now
+            # rather than on every request.
+            try:
+                pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as error:
+                raise TypeError(
+                    '{} must be picklable to run methods in other processes: '
+                    '{}'.format(self.__class__.__name__, error)) from error
+
+        if self.svr_processes:
+            self._workers = ProcessPoolExecutor(
+                max_workers=self.svr_processes, initializer=_init_worker,
+                initargs=(self,))
+        try:
+            asyncio.run(self._serve(timeout, max_requests))
+        except KeyboardInterrupt:
+            self._log.debug('Stopping.')
+        finally:
+            if self._workers is not None:
+                self._workers.shutdown()
+                self._workers = None
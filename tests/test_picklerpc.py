@@ -1,99 +1,717 @@
-import logging
-import time
-from threading import Thread
-
-import pytest
-from picklerpc import PickleRpcClient, PickleRpcServer
-
-
-log = logging.getLogger()
-
-
-@pytest.fixture
-def client():
-    return PickleRpcClient('127.0.0.1', 62000, protocol=2)
-
-
-@pytest.fixture
-def server():
-    # Create a new subclass with a ping method.
-    class Pinger(PickleRpcServer):
-        """Example class"""
-
-        def __init__(self, host='0.0.0.0', port=62000, protocol=None):
-            """Prepare a Pinger for use."""
-            super(Pinger, self).__init__(host=host, port=port, protocol=protocol)
-            self.name = 'foo'
-
-        def ping(self):
-            """
-            Returns PONG, and just for testing.
-
-            Returns (str):
-                PONG.
-            """
-            return 'PONG'
-
-        def echo(self, message):
-            """
-            Responds back to the caller.
-
-            Args:
-                message (str): Message to receive.
-            
-            Returns (str):
-                Response.
-            """
-            self._log.debug('Hey, we got a message: %r', message)
-            return 'I received: {}'.format(message)
-
-        def story(self, food='cheese', effect='moldy'):
-            """
-            Responds back to the caller with food.
-
-            Args:
-                food (str): Food to work with.
-                effect (str): What food does.
-
-            Returns (str):
-                Response.
-            """
-            self._log.debug('We got food=%s and effect=%s', food, effect)
-            return 'The {} is {}'.format(food, effect)
-
-        def raise_exception(self):
-            """
-            Just raises an exception.
-
-            Raises:
-                NotImplementedError: Just because.
-            """
-            raise NotImplementedError('Foo!')
-
-    # Start the server and run it for 2 minutes.
-    return Pinger(protocol=2)
-
-
-def test_server_init(server):
-    assert server
-
-
-def test_server_running(server):
-    def waiter():
-        stop_at = time.time() + 10
-        log.info('Looking for svr_running for at least 10 seconds.')
-        while time.time() < stop_at:
-            if server.svr_running:
-                log.info('Found it.')
-                return True
-            time.sleep(0.1)
-        else:
-            log.info('Not found in time.')
-            return False
-    
-    assert not server.svr_running
-    waiter = Thread(target=waiter)
-    waiter.start()
-    server.run(1)
-    assert waiter
-    assert not server.svr_running
+import asyncio
+import gc
+import logging
+import pickle
+import queue
+import socket
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock, Thread
+
+import pytest
+from picklerpc import PickleRpcClient, PickleRpcServer, codec, framing
+from picklerpc.framing import open_reader, read_frame, recv_frame, send_frame
+
+
+log = logging.getLogger()
+
+# Pickle protocols to run the server and client tests with.
+PROTOCOLS = sorted({2, pickle.DEFAULT_PROTOCOL, pickle.HIGHEST_PROTOCOL})
+
+
+class Pinger(PickleRpcServer):
+    """Example class"""
+
+    def __init__(self, host='0.0.0.0', port=0, protocol=None, codec='pickle',
+                 executor=None, processes=None):
+        """Prepare a Pinger for use."""
+        super(Pinger, self).__init__(host=host, port=port, protocol=protocol, codec=codec,
+                                     executor=executor, processes=processes)
+        self.name = 'foo'
+
+    def ping(self):
+        """
+        Returns PONG, and just for testing.
+
+        Returns (str):
+            PONG.
+        """
+        return 'PONG'
+
+    def echo(self, message):
+        """
+        Responds back to the caller.
+
+        Args:
+            message (str): Message to receive.
+
+        Returns (str):
+            Response.
+        """
+        self._log.debug('Hey, we got a message: %r', message)
+        return 'I received: {}'.format(message)
+
+    def story(self, food='cheese', effect='moldy'):
+        """
+        Responds back to the caller with food.
+
+        Args:
+            food (str): Food to work with.
+            effect (str): What food does.
+
+        Returns (str):
+            Response.
+        """
+        self._log.debug('We got food=%s and effect=%s', food, effect)
+        return 'The {} is {}'.format(food, effect)
+
+    def double(self, data):
+        """
+        Doubles up some data.
+
+        Args:
+            data (bytearray): Data to double.
+
+        Returns (bytearray):
+            The data, twice.
+        """
+        return data * 2
+
+    def raise_exception(self):
+        """
+        Just raises an exception.
+
+        Raises:
+            NotImplementedError: Just because.
+        """
+        raise NotImplementedError('Foo!')
+
+
+@pytest.fixture
+def no_gc():
+    """Keep garbage collections from pausing the timed tests."""
+    enabled = gc.isenabled()
+    gc.disable()
+    yield
+    if enabled:
+        gc.enable()
+
+
+@pytest.fixture(scope='module')
+def executor():
+    """Thread pool for tests to run helpers in, shared across the module."""
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        yield pool
+
+
+@pytest.fixture(scope='module', params=PROTOCOLS)
+def server(request):
+    svr = Pinger(protocol=request.param)
+    yield svr
+    # Tests that run it must leave it stopped for the next one.
+    assert not svr.svr_running
+
+
+@contextmanager
+def _running(svr):
+    """Run a server in the background for the tests that need to talk to one."""
+    thread = Thread(target=svr.run, daemon=True)
+    thread.start()
+    try:
+        assert svr.wait_until_ready(10)
+        yield svr
+    finally:
+        svr.stop()
+        thread.join()
+
+
+@pytest.fixture(scope='module')
+def running_server():
+    with _running(Pinger(protocol=pickle.HIGHEST_PROTOCOL)) as svr:
+        yield svr
+
+
+@pytest.fixture(scope='module')
+def msgpack_server():
+    pytest.importorskip('msgspec')
+    with _running(Pinger(codec='msgpack')) as svr:
+        yield svr
+
+
+@pytest.fixture(params=PROTOCOLS)
+def client(request, running_server):
+    cli = PickleRpcClient('127.0.0.1', running_server.svr_port, protocol=request.param)
+    yield cli
+    cli.close()
+
+
+@pytest.fixture
+def msgpack_client(msgpack_server):
+    cli = PickleRpcClient('127.0.0.1', msgpack_server.svr_port, codec='msgpack')
+    yield cli
+    cli.close()
+
+
+@pytest.mark.parametrize('size', [0, 10, 100000])
+def test_frame_round_trip(size):
+    left, right = socket.socketpair()
+    with left, right, open_reader(right) as reader:
+        payload = bytes(range(256)) * (size // 256) + b'x' * (size % 256)
+        # Two frames back to back come out separately.
+        send_frame(left, payload)
+        send_frame(left, b'next')
+        with recv_frame(reader) as (data, buffers):
+            assert data == payload
+            assert buffers == []
+        with recv_frame(reader) as (data, buffers):
+            assert data == b'next'
+
+
+def test_frame_truncated():
+    left, right = socket.socketpair()
+    with right, open_reader(right) as reader:
+        with left:
+            send_frame(left, b'hello')
+            # Promise 10 bytes, deliver 5.
+            left.sendall(b'\x00\x00\x00\x0a\x00\x00\x00\x00hello')
+        with recv_frame(reader) as (data, _):
+            assert data == b'hello'
+        with pytest.raises(EOFError):
+            with recv_frame(reader):
+                pass
+
+
+def test_server_init(server):
+    assert server
+
+
+def test_ext_methods(server):
+    methods = server._ext_methods
+    assert [name for name, _ in methods] == ['double', 'echo', 'ping', 'raise_exception', 'story']
+    assert server._ext_methods is methods
+    assert dict(methods)['ping'].startswith('Returns PONG, and just for testing.\n\nReturns (str):\n    PONG.')
+
+
+def test_scan_skips_properties():
+    class Counted(Pinger):
+        reads = 0
+
+        @property
+        def costly(self):
+            Counted.reads += 1
+            return 'value'
+
+        @staticmethod
+        def helper():
+            return 'helped'
+
+    svr = Counted()
+    assert 'helper' in dict(svr._ext_methods)
+    assert 'costly' not in dict(svr._ext_methods)
+    assert Counted.reads == 0
+    assert svr._get_result('costly', (), {}) == 'value'
+    assert svr._get_result('helper', (), {}) == 'helped'
+
+
+def test_str(server):
+    text = str(server)
+    assert '  name      : foo' in text
+    assert "  ('ping', " in text
+    assert '  svr_fqdn  : {}'.format(socket.getfqdn()) in text
+
+
+def test_fqdn_assignable():
+    svr = Pinger()
+    assert svr.svr_fqdn == socket.getfqdn()
+    svr.svr_fqdn = 'rpc.example.com'
+    assert svr.svr_fqdn == 'rpc.example.com'
+    assert svr._get_result('svr_fqdn', (), {}) == 'rpc.example.com'
+
+
+def test_server_running(server, executor):
+    def waiter():
+        log.info('Waiting up to 10 seconds for svr_running.')
+        running = server.wait_until_ready(10) and server.svr_running
+        # Connecting asks for the method list, which is the one request.
+        with PickleRpcClient('127.0.0.1', server.svr_port):
+            pass
+        return running
+
+    assert not server.svr_running
+    found = executor.submit(waiter)
+    server.run(timeout=10, max_requests=1)
+    assert found.result(timeout=12)
+    assert not server.svr_running
+
+
+def test_client_methods(client):
+    assert 'Returns PONG' in client.ping.__doc__
+    assert client.ping() == 'PONG'
+    assert client.story('cake', effect='gone') == 'The cake is gone'
+
+
+def test_server_stop(server):
+    thread = Thread(target=server.run)
+    thread.start()
+    assert server.wait_until_ready(10)
+    # It was asked for any free port, and reports the one it got.
+    assert server.svr_port != 0
+    with PickleRpcClient('127.0.0.1', server.svr_port) as cli:
+        assert cli.ping() == 'PONG'
+        server.stop()
+        thread.join(timeout=5)
+        assert not thread.is_alive()
+        assert not server.svr_running
+        # The server hung up on the connected client too.
+        with pytest.raises(ConnectionError):
+            cli.ping()
+
+
+def test_rpc_latency_nodelay(client, no_gc):
+    sock, _ = client._idle[0]
+    assert sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+    # With Nagle's algorithm on either end, small calls stall for tens of
+    # milliseconds each.
+    start = time.monotonic()
+    for _ in range(100):
+        assert client.ping() == 'PONG'
+    assert time.monotonic() - start < 0.5
+
+
+@pytest.mark.parametrize('size', [10000, 100000, 1000000])
+def test_large_echo(client, size):
+    message = 'x' * size
+    assert client.echo(message) == 'I received: {}'.format(message)
+
+
+def test_msgpack_codec(msgpack_client):
+    assert msgpack_client.story(food='bread') == 'The bread is moldy'
+    with pytest.raises(NotImplementedError, match='Foo!'):
+        msgpack_client.raise_exception()
+
+
+@pytest.mark.skipif('msgpack' not in codec.AVAILABLE_CODECS, reason='needs msgspec')
+def test_msgpack_exceptions():
+    def round_trip(error):
+        return codec.loads(codec.dumps(error, codec='msgpack'), codec='msgpack')
+
+    error = round_trip(KeyError('k'))
+    assert type(error) is KeyError and error.args == ('k',)
+    error = round_trip(UnicodeDecodeError('utf-8', b'\xff', 0, 1, 'invalid start byte'))
+    assert type(error) is UnicodeDecodeError
+    assert error.args == ('utf-8', b'\xff', 0, 1, 'invalid start byte')
+    # Arguments msgpack can't carry are dropped, and an exception that can't
+    # be rebuilt from its message alone comes back as a RemoteError.
+    error = round_trip(ValueError(object()))
+    assert type(error) is ValueError
+    error = round_trip({'__exc__': 'UnicodeDecodeError', 'msg': 'bad byte'})
+    assert type(error) is codec.RemoteError
+    assert str(error) == 'UnicodeDecodeError: bad byte'
+
+
+def test_codec_negotiation(running_server, msgpack_server, monkeypatch):
+    # Servers hand each client the codec it asks for.
+    with PickleRpcClient('127.0.0.1', running_server.svr_port, codec='msgpack') as cli:
+        assert cli.cli_codec == 'msgpack'
+        assert cli.story(food='bread') == 'The bread is moldy'
+    with PickleRpcClient('127.0.0.1', msgpack_server.svr_port) as cli:
+        assert cli.cli_codec == 'pickle'
+        assert cli.double(b'ab') == b'abab'
+    # Unless they can't use it, in which case they pick their own.
+    monkeypatch.setattr('picklerpc.server.AVAILABLE_CODECS', ('pickle',))
+    with PickleRpcClient('127.0.0.1', running_server.svr_port, codec='msgpack') as cli:
+        assert cli.cli_codec == 'pickle'
+        assert cli.ping() == 'PONG'
+
+
+def test_codec_renegotiation(running_server, monkeypatch):
+    with PickleRpcClient('127.0.0.1', running_server.svr_port, codec='msgpack') as cli:
+        assert cli.cli_codec == 'msgpack'
+        # The server stops offering msgpack, and the idle connection drops.
+        monkeypatch.setattr('picklerpc.server.AVAILABLE_CODECS', ('pickle',))
+        sock, _ = cli._idle[0]
+        sock.shutdown(socket.SHUT_RDWR)
+        assert cli.story(food='bread') == 'The bread is moldy'
+        assert cli.cli_codec == 'pickle'
+        # Same again with no idle connection to start from.
+        cli.close()
+        cli.cli_codec = 'msgpack'
+        assert cli.pipeline([('ping', (), {})]) == ['PONG']
+        assert cli.cli_codec == 'pickle'
+
+
+def test_persistent_connection(client, running_server):
+    conns = list(client._idle)
+    with PickleRpcClient('127.0.0.1', running_server.svr_port, protocol=pickle.HIGHEST_PROTOCOL) as other:
+        # Both clients hold a connection open, and both get served.
+        assert client.ping() == 'PONG'
+        assert other.ping() == 'PONG'
+        assert client.ping() == 'PONG'
+    assert other._idle == []
+    assert client._idle == conns
+
+
+def test_keep_alive(running_server, no_gc):
+    with PickleRpcClient('127.0.0.1', running_server.svr_port) as cli:
+        conn = cli._idle[0]
+        start = time.monotonic()
+        for _ in range(1000):
+            cli.ping()
+        elapsed = time.monotonic() - start
+        # Every call went over the one connection.
+        assert cli._idle == [conn]
+    log.info('1000 pings over one connection took %.3f s', elapsed)
+    assert elapsed < 5
+
+
+def test_pipeline(client, monkeypatch):
+    # Short pipelines are sent without a sender thread.
+    monkeypatch.setattr('picklerpc.client.Thread', None)
+    assert client.pipeline([('ping', (), {})] * 100) == ['PONG'] * 100
+    assert client.pipeline([
+        ('story', ('cake',), {'effect': 'gone'}),
+        ('echo', ['hi'], {}),
+        ('name', (), {}),
+    ]) == ['The cake is gone', 'I received: hi', 'foo']
+    # Big batches are split up, and still come back in order.
+    messages = [str(i) * 10000 for i in range(20)]
+    assert client.pipeline([('echo', (m,), {}) for m in messages]) == [
+        'I received: {}'.format(m) for m in messages]
+    with pytest.raises(NotImplementedError):
+        client.pipeline([('ping', (), {}), ('raise_exception', (), {})])
+    # The connection is still good afterwards.
+    assert client.ping() == 'PONG'
+
+
+def test_many_small_calls(running_server, caplog, no_gc):
+    # pytest.ini logs at DEBUG, which would swamp the timing.
+    caplog.set_level(logging.WARNING, logger='picklerpc')
+    # Each call's header and payload go out in one write on both ends.
+    with PickleRpcClient('127.0.0.1', running_server.svr_port) as cli:
+        start = time.monotonic()
+        for _ in range(10000):
+            cli.ping()
+        elapsed = time.monotonic() - start
+    log.info('10000 pings took %.3f s', elapsed)
+    assert elapsed < 10
+
+
+def test_cache_args(running_server, monkeypatch):
+    calls = []
+
+    def counting_dumps(obj, **kwargs):
+        calls.append(obj)
+        return codec.dumps(obj, **kwargs)
+
+    with PickleRpcClient('127.0.0.1', running_server.svr_port, cache_args=True) as cli:
+        monkeypatch.setattr('picklerpc.client.dumps', counting_dumps)
+        for _ in range(1000):
+            assert cli.echo('x') == 'I received: x'
+        assert len(calls) == 1
+        # Equal values of different types are encoded separately.
+        assert cli.echo(1) == 'I received: 1'
+        assert cli.echo(True) == 'I received: True'
+        assert len(calls) == 3
+        # Mutable arguments are never cached.
+        assert cli.double([1]) == [1, 1]
+        assert cli.double([1]) == [1, 1]
+        assert len(calls) == 5
+        # Nor are floats, which would mix up 0.0 and -0.0.
+        assert cli.echo(0.0) == 'I received: 0.0'
+        assert cli.echo(-0.0) == 'I received: -0.0'
+        assert len(calls) == 7
+        # Nor are big arguments.
+        message = 'x' * 2000
+        cli.echo(message)
+        cli.echo(message)
+        assert len(calls) == 9
+
+
+class BigPinger(Pinger):
+    """Pinger with large responses."""
+
+    def __init__(self):
+        """Prepare a BigPinger for use."""
+        super(BigPinger, self).__init__()
+        self.calls = 0
+
+    def big(self, size):
+        """Returns size bytes."""
+        return b'x' * size
+
+    def size(self, data):
+        """Returns the length of data."""
+        return len(data)
+
+    def undecodable(self):
+        """Returns something the client can't unpickle."""
+        self.calls += 1
+        return Undecodable()
+
+
+def test_pipeline_large_responses(caplog):
+    # pytest.ini logs at DEBUG, which would repr every payload.
+    caplog.set_level(logging.WARNING, logger='picklerpc')
+    size = 50 * 1024 * 1024
+    results = []
+    with _running(BigPinger()) as svr, PickleRpcClient('127.0.0.1', svr.svr_port) as cli:
+        # A big answer to the first call while the second, big request is
+        # still going out used to leave both ends blocked sending.
+        calls = [('big', (size,), {}), ('size', (b'y' * size,), {})]
+        thread = Thread(target=lambda: results.append(cli.pipeline(calls)), daemon=True)
+        thread.start()
+        thread.join(timeout=30)
+        assert not thread.is_alive()
+    assert len(results[0][0]) == size
+    assert results[0][1] == size
+
+
+def test_pipeline_reader_error(caplog):
+    caplog.set_level(logging.WARNING, logger='picklerpc')
+    calls = [('undecodable', (), {}), ('size', (b'y' * 50 * 1024 * 1024,), {})]
+    with _running(BigPinger()) as svr, PickleRpcClient('127.0.0.1', svr.svr_port) as cli:
+        # The reader fails while the second request is still going out. Its
+        # own error comes back, and nothing is sent again.
+        with pytest.raises(ImportError, match='client_only'):
+            cli.pipeline(calls)
+        assert svr.calls == 1
+        assert cli.ping() == 'PONG'
+
+
+def test_stale_connection(client):
+    conn = client._idle[0]
+    conn[0].shutdown(socket.SHUT_RDWR)
+    assert client.pipeline([('ping', (), {})] * 2) == ['PONG'] * 2
+    assert conn not in client._idle
+
+
+class FragilePinger(Pinger):
+    """Pinger with a result that can't be pickled."""
+
+    def __init__(self):
+        """Prepare a FragilePinger for use."""
+        super(FragilePinger, self).__init__()
+        self.calls = 0
+
+    def lock(self):
+        """Returns a lock, which can't be pickled."""
+        self.calls += 1
+        return Lock()
+
+
+def _undecodable():
+    """Stand in for a class the server can't import."""
+    raise ImportError('No module named client_only')
+
+
+class Undecodable:
+    """Pickles fine, but fails to unpickle."""
+
+    def __reduce__(self):
+        return _undecodable, ()
+
+
+def test_codec_errors():
+    with _running(FragilePinger()) as svr, PickleRpcClient('127.0.0.1', svr.svr_port) as cli:
+        conn = cli._idle[0]
+        with pytest.raises(TypeError, match='pickle'):
+            cli.lock()
+        # The method ran once, and wasn't retried.
+        assert svr.calls == 1
+        with pytest.raises(ImportError, match='client_only'):
+            cli.echo(Undecodable())
+        # The connection survived both.
+        assert cli.ping() == 'PONG'
+        assert cli._idle == [conn]
+
+
+def test_reconnect(client):
+    sock, _ = client._idle[0]
+    sock.close()
+    assert client.ping() == 'PONG'
+
+
+def test_shared_client(client):
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(client.echo, range(20)))
+    assert results == ['I received: {}'.format(i) for i in range(20)]
+    assert 1 <= len(client._idle) <= 4
+
+
+def test_concurrent_clients(running_server):
+    clients = [PickleRpcClient('127.0.0.1', running_server.svr_port, protocol=pickle.HIGHEST_PROTOCOL)
+               for _ in range(4)]
+    try:
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            results = list(pool.map(lambda c: c.echo('hi'), clients))
+    finally:
+        for cli in clients:
+            cli.close()
+    assert results == ['I received: hi'] * 4
+
+
+def test_process_pool():
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        with _running(Pinger(executor=pool)) as svr:
+            with PickleRpcClient('127.0.0.1', svr.svr_port) as cli:
+                assert cli.echo('hi') == 'I received: hi'
+                with pytest.raises(NotImplementedError):
+                    cli.raise_exception()
+    with _running(Pinger(processes=2)) as svr:
+        with PickleRpcClient('127.0.0.1', svr.svr_port) as cli:
+            assert cli.pipeline([('echo', (i,), {}) for i in range(10)]) == [
+                'I received: {}'.format(i) for i in range(10)]
+            with pytest.raises(NotImplementedError):
+                cli.raise_exception()
+    assert svr._workers is None
+
+
+class LockedPinger(Pinger):
+    """Pinger holding a lock, which can't be pickled."""
+
+    def __init__(self, **kwargs):
+        """Prepare a LockedPinger for use."""
+        super(LockedPinger, self).__init__(**kwargs)
+        self.lock = Lock()
+
+
+def test_process_pool_unpicklable():
+    # Found when the server starts, not on each request.
+    with pytest.raises(TypeError, match='LockedPinger must be picklable'):
+        LockedPinger(processes=2).run()
+    with ProcessPoolExecutor(max_workers=1) as pool:
+        with pytest.raises(TypeError, match='LockedPinger must be picklable'):
+            LockedPinger(executor=pool).run()
+
+
+def test_executor_error():
+    pool = ThreadPoolExecutor(max_workers=1)
+    pool.shutdown()
+    with _running(Pinger(executor=pool)) as svr:
+        # The server answers with the error rather than hanging up.
+        with pytest.raises(RuntimeError, match='shutdown'):
+            PickleRpcClient('127.0.0.1', svr.svr_port)
+
+
+def test_dispatch(client):
+    assert client._send_command('name') == 'foo'
+    with pytest.raises(NotImplementedError):
+        client.raise_exception()
+    # Only public members are reachable.
+    for command in ['run', 'stop', 'wait_until_ready', '_get_result', '__class__']:
+        with pytest.raises(AttributeError):
+            client._send_command(command)
+
+
+def test_out_of_band_buffers(running_server):
+    data = bytearray(range(256)) * 1000
+    buffers = []
+    payload = codec.dumps(pickle.PickleBuffer(data), protocol=5, buffers=buffers)
+    assert len(buffers) == 1 and len(payload) < 100
+    assert codec.loads(payload, buffers=buffers) == data
+    with PickleRpcClient('127.0.0.1', running_server.svr_port, protocol=5) as client:
+        assert client.double(pickle.PickleBuffer(data)) == data * 2
+    # Protocol 2 has no out-of-band support, and pickles it in-band instead.
+    with PickleRpcClient('127.0.0.1', running_server.svr_port, protocol=2) as client:
+        assert client.double(data) == data * 2
+
+
+def test_gc_pause(monkeypatch):
+    payload = codec.dumps(list(range(10000)))
+    seen = []
+    decode = codec._decode
+
+    def nested(data, name, buffers):
+        seen.append(gc.isenabled())
+        if len(seen) == 1:
+            # A second decode starting and finishing inside the first leaves
+            # the collector paused for the rest of the first.
+            codec.loads(data, codec=name, buffers=buffers, pause_gc=True)
+            seen.append(gc.isenabled())
+        return decode(data, name, buffers)
+
+    monkeypatch.setattr(codec, '_decode', nested)
+    assert gc.isenabled()
+    codec.loads(payload, pause_gc=True)
+    assert seen == [False, False, False]
+    assert gc.isenabled()
+    # Without pause_gc, as on the server, the collector is left alone.
+    monkeypatch.setattr(codec, '_decode', lambda *args: gc.isenabled())
+    assert codec.loads(payload)
+    # And so it is when someone else has turned it off.
+    gc.disable()
+    try:
+        codec.loads(payload, pause_gc=True)
+        assert not gc.isenabled()
+    finally:
+        gc.enable()
+
+
+def test_frame_buffers():
+    left, right = socket.socketpair()
+    with left, right, open_reader(right) as reader:
+        send_frame(left, b'head', [memoryview(b'one'), memoryview(b'two')])
+        with recv_frame(reader) as (data, buffers):
+            assert data == b'head'
+            assert buffers == [b'one', b'two']
+            assert all(type(buffer) is bytearray for buffer in buffers)
+
+
+def test_read_frame_buffers():
+    async def receive(sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        try:
+            return await read_frame(reader)
+        finally:
+            writer.close()
+
+    left, right = socket.socketpair()
+    with left:
+        send_frame(left, b'head', [memoryview(b'one'), memoryview(b'two')])
+        data, buffers = asyncio.run(receive(right))
+    assert data == b'head'
+    # Same as the client side, so out-of-band buffers come out writable.
+    assert buffers == [b'one', b'two']
+    assert all(type(buffer) is bytearray for buffer in buffers)
+
+
+def test_frame_failed_allocation(monkeypatch):
+    left, right = socket.socketpair()
+    with left, right, open_reader(right) as reader:
+        left.sendall(framing._HEADER.pack(framing._POOLED_SIZE + 1, 0))
+
+        def no_memory(size):
+            if size > framing._POOLED_SIZE:
+                raise MemoryError
+            return bytearray(size)
+
+        monkeypatch.setattr(framing, 'bytearray', no_memory, raising=False)
+        with pytest.raises(MemoryError):
+            with recv_frame(reader):
+                pass
+        monkeypatch.undo()
+    # The pooled buffer went back once, not twice.
+    pooled = []
+    while True:
+        try:
+            pooled.append(framing._pool.get_nowait())
+        except queue.Empty:
+            break
+    assert len(set(map(id, pooled))) == len(pooled)
+    for buf in pooled:
+        framing._pool.put(buf)
+
+
+def test_frame_many_buffers():
+    left, right = socket.socketpair()
+    with left, right, open_reader(right) as reader:
+        # More buffers than one sendmsg call takes, and more data than the
+        # socket holds, so the send goes out in several partial pieces.
+        chunks = [memoryview(bytes([i % 256]) * 1000) for i in range(2000)]
+        sender = Thread(target=send_frame, args=(left, b'head', chunks))
+        sender.start()
+        with recv_frame(reader) as (data, buffers):
+            assert data == b'head'
+            assert buffers == chunks
+        sender.join()